@@ -31,9 +31,11 @@ def evaluate(net, dataloader, device, amp):
                 dice_score += dice_coeff(mask_pred, mask_true, reduce_batch_first=False)
             else:
                 assert mask_true.min() >= 0 and mask_true.max() < n_classes, 'True mask indices should be in [0, n_classes['
-                # convert to one-hot format
-                mask_true = F.one_hot(mask_true, n_classes).permute(0, 3, 1, 2).float()
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), n_classes).permute(0, 3, 1, 2).float()
+                # convert to one-hot format, kept channels-last like the activations
+                mask_true = F.one_hot(mask_true, n_classes).permute(0, 3, 1, 2).float() \
+                    .contiguous(memory_format=torch.channels_last)
+                mask_pred = F.one_hot(mask_pred.argmax(dim=1), n_classes).permute(0, 3, 1, 2).float() \
+                    .contiguous(memory_format=torch.channels_last)
                 # compute the Dice score, ignoring background
                 dice_score += multiclass_dice_coeff(mask_pred[:, 1:], mask_true[:, 1:], reduce_batch_first=False)
 
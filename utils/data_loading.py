@@ -10,8 +10,18 @@ from os import listdir
 from os.path import splitext, isfile, join
 from pathlib import Path
 from torch.utils.data import Dataset
+from torchvision.transforms import InterpolationMode
 from tqdm import tqdm
 
+try:
+    from torchvision.transforms.v2 import functional as tvF
+except ImportError:  # torchvision < 0.15
+    from torchvision.transforms import functional as tvF
+
+# PIL's Image.NEAREST corresponds to NEAREST_EXACT; plain NEAREST is the
+# legacy half-pixel-shifted variant and would move mask labels by up to a pixel
+_NEAREST = getattr(InterpolationMode, 'NEAREST_EXACT', InterpolationMode.NEAREST)
+
 
 def load_image(filename):
     ext = splitext(filename)[1]
@@ -35,6 +45,47 @@ def unique_mask_values(idx, mask_dir, mask_suffix):
         raise ValueError(f'Loaded masks should have 2 or 3 dimensions, found {mask.ndim}')
 
 
+class CUDAPrefetcher:
+    """Iterates a DataLoader and copies the next batch to the GPU on a side
+    stream while the current batch is still being computed on."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return {
+                'image': batch['image'].to(
+                    device=self.device,
+                    dtype=torch.float32,
+                    memory_format=torch.channels_last,
+                    non_blocking=True,
+                ),
+                'mask': batch['mask'].to(device=self.device, dtype=torch.long, non_blocking=True),
+            }
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            # keep the copies alive on the compute stream before reusing the side stream
+            batch['image'].record_stream(torch.cuda.current_stream())
+            batch['mask'].record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(it)
+            yield batch
+
+
 class BasicDataset(Dataset):
     def __init__(self, images_dir: str, mask_dir: str, scale: float = 1.0, mask_suffix: str = ''):
         self.images_dir = Path(images_dir)
@@ -57,19 +108,56 @@ class BasicDataset(Dataset):
 
         self.mask_values = list(sorted(np.unique(np.concatenate(unique), axis=0).tolist()))
         logging.info(f'Unique mask values: {self.mask_values}')
+        self.preloaded = False
+        self._cache = None
 
     def __len__(self):
         return len(self.ids)
 
+    def preload(self):
+        """Decode and preprocess every sample once, keeping the tensors in host
+        memory so later epochs skip the image decode and resize entirely. The
+        cache stays pageable; collation copies samples into a fresh batch
+        tensor anyway, which the DataLoader's pin_memory=True then pins."""
+        if self.preloaded:
+            return
+        cache = []
+        for idx in tqdm(range(len(self.ids)), desc='Preloading dataset', unit='img'):
+            cache.append(self._load_item(idx))
+        self._cache = cache
+        self.preloaded = True
+        logging.info(f'Preloaded {len(cache)} samples into host memory')
+
     @staticmethod
     def preprocess(mask_values, pil_img, scale, is_mask):
         w, h = pil_img.size
         newW, newH = int(scale * w), int(scale * h)
         assert newW > 0 and newH > 0, 'Scale is too small, resized images would have no pixel'
-        pil_img = pil_img.resize((newW, newH), resample=Image.NEAREST if is_mask else Image.BICUBIC)
         img = np.asarray(pil_img)
 
+        # resize as a tensor through torchvision's vectorized kernels instead
+        # of PIL: skips the extra PIL resample + numpy round trip, and the same
+        # ops work on GPU tensors if the pipeline is ever moved device-side
+        was_2d = img.ndim == 2
+        t = torch.from_numpy(img.copy())
+        t = t.unsqueeze(0) if was_2d else t.permute(2, 0, 1)  # -> (C, H, W)
+        mask_dtype = t.dtype
+        if is_mask and mask_dtype not in (torch.uint8, torch.float32):
+            # .npy/.pt and bilevel masks arrive as bool/int32/int64, which the
+            # resize kernels don't cover; nearest only picks source pixels, so
+            # a float round trip keeps the label values bit-exact
+            t = t.float()
+        t = tvF.resize(
+            t,
+            [newH, newW],
+            interpolation=_NEAREST if is_mask else InterpolationMode.BICUBIC,
+            antialias=not is_mask,
+        )
+        if is_mask and t.dtype != mask_dtype:
+            t = t.to(mask_dtype)
+
         if is_mask:#处理的是mask
+            img = t.squeeze(0).numpy() if was_2d else t.permute(1, 2, 0).numpy()
             mask = np.zeros((newH, newW), dtype=np.int64)
             for i, v in enumerate(mask_values):
                 if img.ndim == 2:
@@ -80,10 +168,7 @@ class BasicDataset(Dataset):
             return mask
 
         else:#处理的是输入img
-            if img.ndim == 2:
-                img = img[np.newaxis, ...]#图像的维度从 (H, W) 转换为 (1, H, W)
-            else:
-                img = img.transpose((2, 0, 1))#转换为 (C, H, W)
+            img = t.numpy()#已是 (C, H, W)
 
             if (img > 1).any():#图像的值范围缩放到 [0, 1]
                 img = img / 255.0
@@ -91,6 +176,11 @@ class BasicDataset(Dataset):
             return img
 
     def __getitem__(self, idx):
+        if self._cache is not None:
+            return self._cache[idx]
+        return self._load_item(idx)
+
+    def _load_item(self, idx):
         name = self.ids[idx]
         mask_file = list(self.mask_dir.glob(name + self.mask_suffix + '.*'))
         img_file = list(self.images_dir.glob(name + '.*'))
@@ -26,3 +26,14 @@ def dice_loss(input: Tensor, target: Tensor, multiclass: bool = False):
     # Dice loss (objective to minimize) between 0 and 1
     fn = multiclass_dice_coeff if multiclass else dice_coeff
     return 1 - fn(input, target, reduce_batch_first=True)
+
+
+def multiclass_dice_loss_from_labels(probs: Tensor, target: Tensor, epsilon: float = 1e-6):
+    # Same value as dice_loss(probs, one_hot(target).permute(0, 3, 1, 2).float(),
+    # multiclass=True) but without materializing the one-hot target: gathering
+    # the probability at the label index gives the intersection, and both set
+    # cardinalities reduce to the pixel count since the probabilities sum to 1
+    # per pixel and the one-hot rows sum to 1 per pixel.
+    inter = 2 * probs.gather(1, target.unsqueeze(1)).sum()
+    sets_sum = 2.0 * target.numel()
+    return 1 - (inter + epsilon) / (sets_sum + epsilon)